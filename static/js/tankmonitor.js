@@ -110,12 +110,14 @@ var tankmonitor = {
         event_sock.onmessage = function (e) {
             var $current_depth = $('#current-value');
             var $current_unit = $('#current-log-unit')
-            e = $.parseJSON(e.data);
-            if (e.event === 'log_value' && e.category === tankmonitor.get_selected_category()) {
-                $current_depth.html(e.value.toFixed(tankmonitor.category_precision[e.category]));
-                var unit_label_html = e.category === 'density' ? 'g/cm<sup>3</sup>' : e.unit;
-                $current_unit.html(unit_label_html)
-            }
+            // Each message is a list of events, at most one per category
+            $.each($.parseJSON(e.data), function (i, event) {
+                if (event.event === 'log_value' && event.category === tankmonitor.get_selected_category()) {
+                    $current_depth.html(event.value.toFixed(tankmonitor.category_precision[event.category]));
+                    var unit_label_html = event.category === 'density' ? 'g/cm<sup>3</sup>' : event.unit;
+                    $current_unit.html(unit_label_html)
+                }
+            });
         };
         $('div.tankchart').each(function (ix, elem) {
             tankmonitor.setup_graph($(elem));
@@ -1,4 +1,5 @@
-from collections import deque, namedtuple
+from array import array
+from collections import namedtuple
 
 default_max_log_records = 1440
 default_alert_rate_threshold = -2.0
@@ -6,56 +7,84 @@ TankLogRecord = namedtuple("TankLogRecord", "timestamp value")
 TankAlert = namedtuple("TankAlert", "timestamp value delta")
 
 
-def find_delta(record, prev_rec):
-    """Returns the interval in seconds and the rate of change per minute between the two
-    log records. Returns None, None if the interval is zero (rate of change is infinite)"""
-    if prev_rec is None:
-        return None, None
-    interval = record.timestamp - prev_rec.timestamp
-    if interval == 0:
-        return None, None
-    return interval, 60.0 * (record.value - prev_rec.value) / interval
+class RecordBuffer:
+    """A fixed-size ring buffer of (timestamp, value) records. Records are kept as two parallel
+    arrays of C doubles rather than a deque of TankLogRecords, so a full buffer costs 16 bytes per
+    record and no per-record objects. value_typecode is the array typecode for the values, e.g. 'l'
+    for integer readings, so they come back as ints rather than floats."""
+
+    def __init__(self, max_records, value_typecode='d'):
+        self.max_records = max_records
+        self._timestamps = array('d', [0.0]) * max_records
+        self._values = array(value_typecode, [0]) * max_records
+        self._head = 0   # index of the slot the next record will be written to
+        self._count = 0  # number of valid records in the buffers
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        if not self.max_records:
+            return
+        self._timestamps[self._head] = timestamp
+        self._values[self._head] = value
+        self._head = (self._head + 1) % self.max_records
+        if self._count < self.max_records:
+            self._count += 1
+
+    def _ordered(self, buf):
+        """Returns the valid region of the given array, oldest record first"""
+        if self._count < self.max_records:
+            return buf[:self._count]
+        return buf[self._head:] + buf[:self._head]
+
+    def records(self):
+        """Returns the buffered records, oldest first, as a list of (timestamp, value) tuples.
+        Plain tuples are much cheaper to build than TankLogRecords, and serialize the same way."""
+        return zip(self._ordered(self._timestamps), self._ordered(self._values))
 
 
 class TankLogger:
     def __init__(self, log_interval, max_log_records=default_max_log_records,
                  alert_rate_threshold=default_alert_rate_threshold,
-                 comparator=lambda d, t: d < t):
+                 comparator=lambda d, t: d < t, value_typecode='d'):
         self.log_interval = log_interval
         self.next_capture = 0
         self.alert_rate_threshold = alert_rate_threshold
-        self.records = deque(maxlen=max_log_records)
         self.comparator = comparator
+        self._records = RecordBuffer(max_log_records, value_typecode)
+        # Deltas are computed once, as records are captured, rather than on every read. There is
+        # one fewer delta than there are records.
+        self._deltas = RecordBuffer(max(max_log_records - 1, 0))
+        self._last = None  # most recently captured record
 
     def offer(self, tank_log_record):
         """May add the given tank record to the buffer, if it hasn't already added a record to the
         buffer for the current log interval"""
         if tank_log_record.timestamp > self.next_capture:
-            self.records.append(tank_log_record)
-            self.next_capture = tank_log_record.timestamp + self.log_interval
-            prev_rec = self.records[-1] if self.records else None
-            if prev_rec:
-                interval, delta = find_delta(tank_log_record, prev_rec)
-                if delta is not None and self.alert_rate_threshold is not None and self.comparator(delta, self.alert_rate_threshold):
-                    return TankAlert(tank_log_record.timestamp,
-                                     tank_log_record.value,
-                                     delta)
+            timestamp, value = tank_log_record
+            prev_rec = self._last
+            self._records.append(timestamp, value)
+            self._last = tank_log_record
+            self.next_capture = timestamp + self.log_interval
+            if prev_rec is None:
+                return
+            prev_timestamp, prev_value = prev_rec
+            interval = timestamp - prev_timestamp
+            if interval == 0:  # rate of change is infinite
+                return
+            # Rate of change per minute
+            delta = 60.0 * (value - prev_value) / interval
+            self._deltas.append(prev_timestamp + 0.5*interval, delta)
+            if self.alert_rate_threshold is not None and self.comparator(delta, self.alert_rate_threshold):
+                return TankAlert(timestamp, value, delta)
+
+    @property
+    def records(self):
+        return self._records.records()
 
     @property
     def deltas(self):
-        dlog = []
-        prev_rec = None
-        for record in self.records:
-            if prev_rec is None:
-                prev_rec = record
-                continue
-            interval, delta = find_delta(record, prev_rec)
-            if not interval:
-                continue
-            dlog.append(TankLogRecord(
-                timestamp=prev_rec.timestamp + 0.5*interval,
-                # Actually change in value per minute
-                value=delta
-            ))
-            prev_rec = record
-        return dlog
\ No newline at end of file
+        """Rate of change between consecutive records, per minute, timestamped at the midpoint
+        of the two records"""
+        return self._deltas.records()
@@ -1,39 +1,107 @@
+import atexit
 import os
+import signal
 import sys
 from threading import Lock, Thread
+from Queue import Queue, Empty
 from tornado.web import Application, RequestHandler, HTTPError, StaticFileHandler
 from tornado.httpserver import HTTPServer
 from tornado.template import Template
 from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.gen import coroutine
 from sockjs.tornado import SockJSRouter, SockJSConnection
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import json
 import binascii
 from tanklogger import TankLogger, TankLogRecord, TankAlert
-from functools import partial
-from datetime import datetime, timedelta
-from time import time, sleep
-from serial import Serial
+from time import time, localtime, strftime
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = time
+from serial import Serial, SerialException
 from email.mime.text import MIMEText
 from concurrent.futures import ThreadPoolExecutor
 import struct
 import smtplib
+import socket
 import base64
+import hmac
 import settings as appconfig
 from PIL import Image, ImageDraw, ImageFont
 import pcd8544.lcd as lcd
 import netifaces as ni
 import wiringpi2 as wiringpi
 
-log_level_reset_at = None
+log_level_reset_timeout = None  # IOLoop timeout that resets the level, see SyslogStatusHandler.post
+log_level_reset_desc = None  # when that timeout fires, formatted for the /syslog status
+
+
+EXC_FORMATTER = logging.Formatter()  # formats tracebacks before records are queued
+
+
+class BackgroundLogHandler(logging.Handler):
+    """Wraps a handler so that its records are written by the log writer thread, keeping file
+    I/O and log rollover off the IOLoop and serial reader threads. emit formats the record's
+    message and traceback in place, replacing its msg, args and exc_info, so the wrapped handler
+    and any other handler that sees the record afterwards get it already formatted."""
+
+    records = Queue()
+
+    def __init__(self, handler):
+        logging.Handler.__init__(self, handler.level)
+        self.handler = handler
+
+    def emit(self, record):
+        try:
+            # Format the message and traceback now, while the args and exc_info are still valid
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = EXC_FORMATTER.formatException(record.exc_info)
+                record.exc_info = None
+            BackgroundLogHandler.records.put_nowait((self.handler, record))
+        except Exception:
+            self.handleError(record)
+
+    @staticmethod
+    def write_records():
+        while True:
+            handler, record = BackgroundLogHandler.records.get()
+            handler.handle(record)
+
+    @staticmethod
+    def flush_records():
+        """Writes out anything still queued; called at exit since the writer thread is a daemon"""
+        while True:
+            try:
+                handler, record = BackgroundLogHandler.records.get_nowait()
+            except Empty:
+                return
+            handler.handle(record)
+
+    @staticmethod
+    def start(loggers):
+        """Wraps the handlers of the given loggers and starts the log writer thread. main.html
+        imports this module a second time, as 'tankmonitor', so this is only called from
+        __main__; handlers that are already wrapped are left alone."""
+        for logger in loggers:
+            logger.handlers = [handler if isinstance(handler, BackgroundLogHandler)
+                               else BackgroundLogHandler(handler)
+                               for handler in logger.handlers]
+        log_writer_thread = Thread(target=BackgroundLogHandler.write_records, name="log-writer")
+        log_writer_thread.daemon = True
+        log_writer_thread.start()
+        atexit.register(BackgroundLogHandler.flush_records)
+
 
 logging.basicConfig(filename="syslog/tankmonitor.log",
                     format='%(asctime)s %(levelname)-8s %(message)s',
                     level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
-
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 logging.getLogger("tornado.access").addHandler(logging.NullHandler())
@@ -53,33 +121,68 @@ disp_font_sm = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMonoBo
 BTN_IN = 2   # wiringpi pin ID
 BTN_OUT = 3  # wiringpi pin ID
 VALVE_GPIO = 6   # wiringpi pin ID
+BUTTON_POLL_MS = 100  # only used when wiringpi can't deliver button interrupts
+DISPLAY_REFRESH_MS = 500
+DISPLAY_REFRESH_TICKS = DISPLAY_REFRESH_MS // BUTTON_POLL_MS
+IP_ADDR_REFRESH_SECS = 30
+EVENT_FLUSH_MS = 200
+SYSLOG_LIST_REFRESH_SECS = 5
+LOG_LEVEL_RESET_SECS = 30 * 60  # how long POST /syslog turns on debug logging for
+EVENT_BACKLOG_LIMIT = 64 * 1024  # queued event bytes a slow listener may have before events are dropped
 
 thread_pool = ThreadPoolExecutor(2)
 
+# Settings read on hot paths are resolved once at import.
+EMAIL_PERIOD = appconfig.EMAIL['period']
+DEPTH_ALERT_THRESHOLD = appconfig.ALERT_THRESHOLDS['depth']
+DENSITY_ALERT_THRESHOLD = appconfig.ALERT_THRESHOLDS['density']
+TSV_HEADERS = dict((category, '"Timestamp"\t"%s"\n' % log_unit)
+                   for category, log_unit in appconfig.LOG_UNITS.items())
+TSV_DELTA_HEADERS = dict((category, '"Timestamp"\t"Rate of Change (%s/min)"\n' % log_unit)
+                         for category, log_unit in appconfig.LOG_UNITS.items())
+
 
 class EventConnection(SockJSConnection):
-    event_listeners = set()
+    # Replaced rather than mutated whenever a listener joins or leaves, so notify_all can iterate
+    # the tuple it read without copying it first.
+    event_listeners = ()
     def on_open(self, request):
-        self.event_listeners.add(self)
+        EventConnection.event_listeners += (self,)
 
     def on_close(self):
-        self.event_listeners.remove(self)
+        EventConnection.event_listeners = tuple(l for l in EventConnection.event_listeners
+                                                if l is not self)
 
     @classmethod
-    def notify_all(cls, msg_dict):
-        failed_listeners = set()
+    def notify_all(cls, events):
+        """Sends a list of events to every listener, as a single message"""
+        # Every listener gets the same message, so only serialize it once, without padding
+        msg = json.dumps(events, separators=(',', ':'))
+        failed_listeners = []
         for event_listener in EventConnection.event_listeners:
+            # Polling transports queue events until the client next connects; a client that has
+            # fallen this far behind misses events rather than growing its queue without bound
+            if len(getattr(event_listener.session, 'send_queue', '')) > EVENT_BACKLOG_LIMIT:
+                continue
             try:
-                event_listener.send(json.dumps(msg_dict))
-            except:
-                log.debug('Removing listener ' + event_listener)
+                event_listener.send(msg)
+            except Exception:
+                log.debug('Removing listener %s', event_listener)
                 failed_listeners.append(event_listener)
-        EventConnection.event_listeners = EventConnection.event_listeners.difference(failed_listeners)
+        if failed_listeners:
+            EventConnection.event_listeners = tuple(l for l in EventConnection.event_listeners
+                                                    if l not in failed_listeners)
 
 
 class MainPageHandler(RequestHandler):
     def get(self, *args, **kwargs):
-        self.render('main.html')
+        # main.html only depends on settings and static file versions, so it is rendered once
+        page = self.application.main_page
+        if page is None:
+            page = self.render_string('main.html')
+            if not self.settings.get('debug'):  # keep template edits visible while debugging
+                self.application.main_page = page
+        self.finish(page)
 
 CATEGORY_LABELS = {
     'depth': 'Volume',
@@ -88,37 +191,61 @@ CATEGORY_LABELS = {
     'distance': 'Raw Maxbotix Reading'
 }
 
+TIMESTAMP_CACHE_SIZE = 4 * 3 * 2 * 1440  # records and deltas held by every logger
+_timestamp_cache = {}
+
+
+def format_timestamp(timestamp):
+    """Formats a log record timestamp (truncated to the second) for TSV output. Log records are
+    downloaded repeatedly while they sit in the loggers' buffers, so the formatted strings are cached."""
+    timestamp = int(timestamp)
+    formatted = _timestamp_cache.get(timestamp)
+    if formatted is None:
+        if len(_timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+            _timestamp_cache.clear()
+        formatted = '%04d-%02d-%02d %02d:%02d:%02d' % localtime(timestamp)[:6]
+        _timestamp_cache[timestamp] = formatted
+    return formatted
+
+
 class LogDownloadHandler(RequestHandler):
     def get(self, category, logger_interval):
         fmt = self.get_argument('format', 'nvd3')  # or tsv
         deltas = self.get_argument('deltas', False)
-        loggers = getattr(self.application, 'loggers', None)
-        loggers = filter(lambda l: l.log_interval == int(logger_interval), loggers[category])
-        if not loggers:
-            raise Exception("No logger matching " + logger_interval)
-        logger = loggers[0]
-        records = logger.deltas if deltas else logger.records
-        log.debug("Returning %d records for %s" % (len(records), category))
+        try:
+            logger = self.application.loggers_by_interval[(category, int(logger_interval))]
+        except (KeyError, ValueError):
+            raise HTTPError(404, reason="No logger matching %s/%s" % (category, logger_interval))
         if fmt == 'nvd3':
-            self.finish({'key': CATEGORY_LABELS[category],
-                         'values': list(records)})
+            # The JSON only changes when the logger captures a record, so it is cached until then
+            cache_key = (category, logger.log_interval, bool(deltas))
+            captured_at, body = self.application.nvd3_cache.get(cache_key, (None, None))
+            if captured_at != logger.next_capture:
+                records = logger.deltas if deltas else logger.records
+                log.debug("Serializing %d records for %s", len(records), category)
+                body = json.dumps({'key': CATEGORY_LABELS[category], 'values': records})
+                self.application.nvd3_cache[cache_key] = (logger.next_capture, body)
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.finish(body)
         elif fmt == 'tsv':
+            records = logger.deltas if deltas else logger.records
+            log.debug("Returning %d records for %s", len(records), category)
             self.set_header('Content-Type', 'text/plain')
-            log_unit = appconfig.LOG_UNITS[category]
-            if deltas:
-                self.write('"Timestamp"\t"Rate of Change (%s/min)"\n' % log_unit)
-            else:
-                self.write('"Timestamp"\t"%s"\n' % log_unit)
-            self.write_tsv(records)
+            self.write_tsv(TSV_DELTA_HEADERS[category] if deltas else TSV_HEADERS[category],
+                           records)
             self.finish()
 
-    def write_tsv(self, records):
-        for record in records:
-            timestamp = datetime.fromtimestamp(record.timestamp).strftime('%Y-%m-%d %H:%M:%S')
-            self.write(str(timestamp))
-            self.write('\t')
-            self.write(str(record.value))
-            self.write('\n')
+    def write_tsv(self, header, records):
+        """Writes the header line and records as a single chunk"""
+        rows = ['%s\t%s\n' % (format_timestamp(timestamp), value)
+                for timestamp, value in records]
+        rows.insert(0, header)
+        self.write(''.join(rows))
+
+
+# The Authorization header a valid valve control request carries
+VALVE_AUTHORIZATION = 'Basic ' + base64.b64encode('%s:%s' % (appconfig.CREDENTIALS['username'],
+                                                             appconfig.CREDENTIALS['password']))
 
 
 class ValveHandler(RequestHandler):
@@ -147,14 +274,10 @@ class ValveHandler(RequestHandler):
             self.set_header('WWW-Authenticate', 'Basic realm=Restricted')
             self.finish()
             return
-        else:
-            auth_decoded = base64.decodestring(auth_header[6:])
-            hdr_auth = dict()
-            hdr_auth['username'], hdr_auth['password'] = auth_decoded.split(':', 2)
-            if hdr_auth != appconfig.CREDENTIALS:
-                raise HTTPError(403, reason="Valve control credentials invalid")
+        elif not hmac.compare_digest(auth_header, VALVE_AUTHORIZATION):
+            raise HTTPError(403, reason="Valve control credentials invalid")
         ValveHandler._valve_state = not ValveHandler._valve_state
-        ValveHandler._transition_time = datetime.now().isoformat()[:19]
+        ValveHandler._transition_time = strftime('%Y-%m-%dT%H:%M:%S')
         wiringpi.digitalWrite(VALVE_GPIO, int(ValveHandler._valve_state))
         self.finish(ValveHandler.get_state())
 
@@ -169,235 +292,399 @@ class ValveHandler(RequestHandler):
 class TankMonitor(Application):
     def __init__(self, handlers=None, **settings):
         super(TankMonitor, self).__init__(handlers, **settings)
+        # The serial readers, periodic callbacks and request handlers all run on this IOLoop
+        self.io_loop = IOLoop.current()
+        depth_rate_threshold = appconfig.ALERT_RATE_THRESHOLDS['depth']
+        density_rate_threshold = appconfig.ALERT_RATE_THRESHOLDS['density']
+        density_comparator = lambda d, t: d > t
         self.loggers = {
             'depth': [
-                TankLogger(10, alert_rate_threshold=appconfig.ALERT_RATE_THRESHOLDS['depth']),
-                TankLogger(60, alert_rate_threshold=appconfig.ALERT_RATE_THRESHOLDS['depth']),
-                TankLogger(3600, alert_rate_threshold=appconfig.ALERT_RATE_THRESHOLDS['depth'])
+                TankLogger(10, alert_rate_threshold=depth_rate_threshold),
+                TankLogger(60, alert_rate_threshold=depth_rate_threshold),
+                TankLogger(3600, alert_rate_threshold=depth_rate_threshold)
             ],
             'density': [
-                TankLogger(10, alert_rate_threshold=appconfig.ALERT_RATE_THRESHOLDS['density'],
-                           comparator=lambda d, t: d > t),
-                TankLogger(60, alert_rate_threshold=appconfig.ALERT_RATE_THRESHOLDS['density'],
-                           comparator=lambda d, t: d > t),
-                TankLogger(3600, alert_rate_threshold=appconfig.ALERT_RATE_THRESHOLDS['density'],
-                           comparator=lambda d, t: d > t),
+                TankLogger(10, alert_rate_threshold=density_rate_threshold,
+                           comparator=density_comparator),
+                TankLogger(60, alert_rate_threshold=density_rate_threshold,
+                           comparator=density_comparator),
+                TankLogger(3600, alert_rate_threshold=density_rate_threshold,
+                           comparator=density_comparator),
             ],
             'water_temp': [
                 TankLogger(10, alert_rate_threshold=None),
                 TankLogger(60, alert_rate_threshold=None),
                 TankLogger(3600, alert_rate_threshold=None)
             ],
+            # Raw Maxbotix readings are integers; keep them that way in the downloads
             'distance': [
-                TankLogger(10, alert_rate_threshold=None),
-                TankLogger(60, alert_rate_threshold=None),
-                TankLogger(3600, alert_rate_threshold=None)
+                TankLogger(10, alert_rate_threshold=None, value_typecode='l'),
+                TankLogger(60, alert_rate_threshold=None, value_typecode='l'),
+                TankLogger(3600, alert_rate_threshold=None, value_typecode='l')
             ]
         }
+        self.loggers_by_interval = dict(((category, logger.log_interval), logger)
+                                        for category, loggers in self.loggers.items()
+                                        for logger in loggers)
+        self.pending_events = {}  # latest log_value event by category, see flush_events
+        self.main_page = None  # rendered by MainPageHandler on first request
+        self.nvd3_cache = {}  # serialized log downloads, see LogDownloadHandler
         self.latest_raw_val = None
         self.display_expiry = 0
+        # Everything but the reading is rendered into the background, only when the IP address
+        # changes; see render_display_background
+        self.display_background = Image.new('1', (84, 48))
+        self.display_background_ip = None
+        self.display_image = Image.new('1', (84, 48))
+        self.display_draw = ImageDraw.Draw(self.display_image)
+        self.displayed_vals = None
+        self.display_on = None  # unknown until the first update_display
+        self.display_ticks = 0
+        self.ip_addr = None
+        self.ip_addr_refresh_at = 0
+
+    def _offer_log_records(self, timestamp, readings):
+        """Logs a list of (category, value) readings taken together. Like _offer_log_record, this
+        must be called on the app's IOLoop."""
+        for category, value in readings:
+            self._offer_log_record(category, timestamp, value)
 
-    def log_tank_depth(self, tank_depth):
-        """The log* methods can be called from outside the app's IOLoop. They're the
-        only methods that can be called like that"""
-        log.debug("Logging depth: " + str(tank_depth))
-        IOLoop.current().add_callback(partial(self._offer_log_record, 'depth', time(),
-                                              tank_depth))
-
-    def log_density(self, density):
-        log.debug("Logging density: " + str(density))
-        IOLoop.current().add_callback(partial(self._offer_log_record, 'density', time(),
-                                              density))
-
-    def log_water_temp(self, water_temp):
-        log.debug("Logging water temp: " + str(water_temp))
-        IOLoop.current().add_callback(partial(self._offer_log_record, 'water_temp', time(),
-                                              water_temp))
-
-    def log_distance(self, distance):
-        # log.debug("Logging distance:" + str(distance))
-        IOLoop.current().add_callback(partial(self._offer_log_record, 'distance', time(),
-                                              distance))
-
-    @coroutine
     def _offer_log_record(self, category, timestamp, value):
         log_record = TankLogRecord(timestamp=timestamp, value=value)
-        if category == 'depth' and value < appconfig.ALERT_THRESHOLDS['depth']:
-            yield AlertMailer.offer('depth', TankAlert(timestamp=timestamp, value=value, delta=None))
-        elif category == 'density' and value > appconfig.ALERT_THRESHOLDS['density']:
-            yield AlertMailer.offer('density', TankAlert(timestamp=timestamp, value=value, delta=None))
+        if category == 'depth' and value < DEPTH_ALERT_THRESHOLD:
+            AlertMailer.offer('depth', TankAlert(timestamp=timestamp, value=value, delta=None))
+        elif category == 'density' and value > DENSITY_ALERT_THRESHOLD:
+            AlertMailer.offer('density', TankAlert(timestamp=timestamp, value=value, delta=None))
+        alerts = []
+        # Each logger is offered the record independently, so a coarser logger captures on its own
+        # cadence rather than waiting for a finer one; skip the call when the logger isn't due
         for logger in self.loggers[category]:
+            if timestamp <= logger.next_capture:
+                continue
             alert = logger.offer(log_record)
             if alert:
-                yield AlertMailer.offer(alert)
-        EventConnection.notify_all({
-            'event': 'log_value',
-            'unit': appconfig.LOG_UNITS[category],
-            'timestamp': timestamp,
-            'category': category,
-            'value': value
-        })
+                alerts.append(alert)
+        if alerts:
+            # Loggers at different intervals can alert on the same record; only mail the steepest
+            AlertMailer.offer(category, max(alerts, key=lambda alert: abs(alert.delta)))
+        # Most of the time nobody has the page open, so don't build or encode the event
+        if EventConnection.event_listeners:
+            self.pending_events[category] = {
+                'event': 'log_value',
+                'unit': appconfig.LOG_UNITS[category],
+                'timestamp': timestamp,
+                'category': category,
+                'value': value
+            }
+
+    def flush_events(self):
+        """Broadcasts the latest value logged for each category since the last flush, in one
+        message, so the broadcast rate doesn't depend on how fast the sensors are sampled"""
+        if self.pending_events:
+            pending_events, self.pending_events = self.pending_events, {}
+            EventConnection.notify_all(pending_events.values())
+
+    def get_ip_addr(self, now):
+        """Returns eth0's IP address, looking it up at most every IP_ADDR_REFRESH_SECS seconds"""
+        if now >= self.ip_addr_refresh_at:
+            try:
+                self.ip_addr = ni.ifaddresses('eth0')[ni.AF_INET][0]['addr']
+            except (ValueError, KeyError, IndexError):
+                self.ip_addr = "no network"
+            self.ip_addr_refresh_at = now + IP_ADDR_REFRESH_SECS
+        return self.ip_addr
 
     def update_display(self):
-        ip_addr = ni.ifaddresses('eth0')[ni.AF_INET][0]['addr']
-        now = time()
+        now = monotonic()
         if now < self.display_expiry:
-            im = Image.new('1', (84, 48))
-            draw = ImageDraw.Draw(im)
-            if self.latest_raw_val is not None:
-                draw.text((0, 5), self.latest_raw_val, font=disp_font, fill=1)
-            draw.text((0, 0), ip_addr, font=disp_font_sm, fill=1)
-            draw.text((5, 36), "mm to surface", font=disp_font_sm, fill=1)
-            lcd.show_image(im)
-            # clean up
-            del draw
-            del im
-            lcd.set_contrast(disp_contrast_on)
-        else:
+            ip_addr = self.get_ip_addr(now)
+            # Only re-render and re-send the image when something shown on it has changed
+            if (ip_addr, self.latest_raw_val) != self.displayed_vals:
+                if ip_addr != self.display_background_ip:
+                    self.render_display_background(ip_addr)
+                self.display_image.paste(self.display_background)
+                if self.latest_raw_val is not None:
+                    self.display_draw.text((0, 5), self.latest_raw_val, font=disp_font, fill=1)
+                self.displayed_vals = (ip_addr, self.latest_raw_val)
+                lcd.show_image(self.display_image)
+            if not self.display_on:
+                lcd.set_contrast(disp_contrast_on)
+                self.display_on = True
+        elif self.display_on is not False:
             lcd.set_contrast(disp_contrast_off)
             lcd.cls()
+            self.display_on = False
+            self.displayed_vals = None  # the screen is blank now, so redraw when woken
+
+    def render_display_background(self, ip_addr):
+        self.display_background.paste(0, (0, 0) + self.display_background.size)
+        draw = ImageDraw.Draw(self.display_background)
+        draw.text((0, 0), ip_addr, font=disp_font_sm, fill=1)
+        draw.text((5, 36), "mm to surface", font=disp_font_sm, fill=1)
+        self.display_background_ip = ip_addr
+
+    def wake_display(self):
+        self.display_expiry = monotonic() + 60
+
+    def on_display_button(self):
+        """Called from wiringpi's interrupt thread when the display button is pressed"""
+        self.io_loop.add_callback(self.wake_display)
 
     def poll_display_button(self):
         btn_down = wiringpi.digitalRead(BTN_IN)
         if btn_down:
-            self.display_expiry = time() + 60
-
-    def _set_latest_raw_val(self, val):
-        self.latest_raw_val = val
+            self.wake_display()
 
-    def set_latest_raw_val(self, val):
-        """This method can be called from any thread."""
-        IOLoop.instance().add_callback(self._set_latest_raw_val, val)
+    def poll_display(self):
+        """Polls the display button on every call, and refreshes the display on every
+        DISPLAY_REFRESH_TICKS-th call, so both share a single PeriodicCallback."""
+        self.poll_display_button()
+        self.display_ticks += 1
+        if self.display_ticks >= DISPLAY_REFRESH_TICKS:
+            self.display_ticks = 0
+            self.update_display()
 
-    def log_level_reset(self):
-        global log_level_reset_at
-        if log_level_reset_at is not None and log_level_reset_at < datetime.now():
-            log.info("Resetting logging level to INFO")
-            log.setLevel(logging.INFO)
-            log_level_reset_at = None
-
-SERIAL_LOCK = Lock()
+DEPTH_LOG_READINGS = 5  # only every 5th Maxbotix reading is logged as a depth
 
 class MaxbotixHandler:
     def __init__(self, tank_monitor, **kwargs):
-        """kwargs will be passed through to the serial port constructor"""
+        """kwargs will be passed through to the serial port constructor. The port should be
+        opened non-blocking (timeout=0), since it is read from the app's IOLoop."""
         self.serial_port = None
         self.set_serial_port(**kwargs)
-        self.stop_reading = False
         self.tank_monitor = tank_monitor
         self.calibrate_m = 1
         self.calibrate_b = 0
+        self.pending = ''  # bytes read from the port that don't yet form a complete frame
+        self.read_count = 0
 
-    def read(self):
+    def start(self):
+        """Starts reading from the serial port on the app's IOLoop, whenever it has data"""
         log.info("Starting MaxbotixHandler read")
-        val = None
-        read_count = 0
-        while not self.stop_reading:
-            try:
-                with SERIAL_LOCK:
-                    val = self.serial_port.read()
-                    if val == 'R':
-                        val = self.serial_port.read(4)
-                        read_count += 1
-                        if read_count % 5 == 0:  # cheesy kludge to avoid tons of logging
-                            self.tank_monitor.set_latest_raw_val(val)
-                            self.tank_monitor.log_tank_depth(self.convert(val))
-                        self.tank_monitor.log_distance(int(val))
-            except:
-                print "Unable to convert value '" + str(val) + "'"
-                import traceback
-                traceback.print_exc()
-            finally:
-                sleep(0.1)
+        self.tank_monitor.io_loop.add_handler(self.serial_port.fileno(), self.on_readable,
+                                              IOLoop.READ)
+
+    def on_readable(self, fd, events):
+        try:
+            # inWaiting rather than in_waiting, which needs pyserial 3
+            data = self.serial_port.read(self.serial_port.inWaiting() or 1)
+        except SerialException:
+            log.exception("Unable to read from Maxbotix serial port, stopping MaxbotixHandler")
+            self.shutdown()
+            return
+        # Frames look like 'R1234\r': an 'R' followed by the 4-digit distance in mm
+        frames = (self.pending + data).split('R')
+        self.pending = 'R' + frames.pop() if len(frames) > 1 else ''
+        for frame in frames[1:]:
+            self.on_reading(frame[:4])
+        if len(self.pending) >= 5:
+            self.on_reading(self.pending[1:5])
+            self.pending = ''
+
+    def on_reading(self, val):
+        try:
+            if len(val) != 4:
+                raise ValueError("truncated frame")
+            distance = int(val)
+        except ValueError:
+            log.warn("Unable to convert value '%s'", val)
+            return
+        now = time()
+        self.read_count += 1
+        if self.read_count % DEPTH_LOG_READINGS == 0:  # cheesy kludge to avoid tons of logging
+            self.tank_monitor.latest_raw_val = val
+            self.tank_monitor._offer_log_record('depth', now, self.convert(val))
+        self.tank_monitor._offer_log_record('distance', now, distance)
 
     def calibrate(self, m, b):
         """ Defines the parameters for a linear equation y=mx+b, which is used
         to convert the output of the sensor to whatever units are specified in the settings file.
         """
-        log.info("Calibrating Maxbotix interface with m=%2.4f, b=%2.4f" % (m, b))
+        log.info("Calibrating Maxbotix interface with m=%2.4f, b=%2.4f", m, b)
         self.calibrate_m = float(m)
         self.calibrate_b = float(b)
 
     def convert(self, val):
-        converted = self.calibrate_m * float(val) + self.calibrate_b
+        raw = float(val)
+        converted = self.calibrate_m * raw + self.calibrate_b
         if log.isEnabledFor(logging.DEBUG):
-            log.debug("Raw value %2.4f converted to %2.4f" % (float(val), converted))
+            log.debug("Raw value %2.4f converted to %2.4f", raw, converted)
         return converted
 
     def shutdown(self):
-        self.stop_reading = True
+        self.tank_monitor.io_loop.remove_handler(self.serial_port.fileno())
 
     def set_serial_port(self, **kwargs):
-        with SERIAL_LOCK:
-            self.serial_port = Serial(**kwargs)
+        self.serial_port = Serial(**kwargs)
 
 
-class DensitrakHandler:
+DENSITRAK_FLOAT = struct.Struct('>f')
+DENSITRAK_READ_DENSITY = b'\x01\x31\x41\x34\x36\x30\x0D\x00'
+DENSITRAK_READ_TEMP = b'\x01\x31\x41\x34\x31\x30\x0D\x00'  # reads degrees F
+DENSITRAK_COMMANDS = (('density', DENSITRAK_READ_DENSITY), ('water_temp', DENSITRAK_READ_TEMP))
+DENSITRAK_RESPONSE_LEN = 17
+DENSITRAK_POLL_SECS = 2
+DENSITRAK_TIMEOUT_SECS = 10
+
 
+class DensitrakHandler:
     def __init__(self, tank_monitor, device_name):
+        """The port is opened non-blocking, since commands are sent and their responses read on
+        the app's IOLoop. Like MaxbotixHandler, this sticks to serial calls pyserial 2.x has."""
         self.device_name = device_name
         self.stop_reading = False
-        self.serial_port = Serial(device_name, baudrate=115200, timeout=10)
+        self.serial_port = Serial(device_name, baudrate=115200, timeout=0)
         self.tank_monitor = tank_monitor
+        self.io_loop = tank_monitor.io_loop
+        self.pending = ''     # bytes of the current command's response read so far
+        self.readings = []    # (category, value) readings taken so far in the current poll
+        self.timeout = None   # IOLoop timeout for the current command's response
+        self.next_poll = None  # IOLoop timeout for the next poll, while waiting between polls
 
-    def read(self):
-        self.serial_port.open()
+    def start(self):
         log.info("Starting Densitrak read")
-        while not self.stop_reading:
-            try:
-                self.tank_monitor.log_density(
-                    self.send_command(b'\x01\x31\x41\x34\x36\x30\x0D\x00'))
-                self.tank_monitor.log_water_temp((5.0/9) * (
-                    self.send_command(b'\x01\x31\x41\x34\x31\x30\x0D\x00') - 32.0))
-            except:
-                log.debug("Failure reading densitrak", exc_info=sys.exc_info())
-            finally:
-                sleep(2)
-
-    def send_command(self, command):
-        with SERIAL_LOCK:
-            self.serial_port.flush()
+        self.io_loop.add_handler(self.serial_port.fileno(), self.on_readable, IOLoop.READ)
+        self.request_readings()
+
+    def request_readings(self):
+        """Starts a poll, which sends each of DENSITRAK_COMMANDS in turn"""
+        self.next_poll = None
+        self.readings = []
+        self.send_command()
+
+    def send_command(self):
+        category, command = DENSITRAK_COMMANDS[len(self.readings)]
+        self.pending = ''
+        try:
+            self.serial_port.flushInput()  # drop any late response to an earlier command
             self.serial_port.write(command)
-            self.serial_port.flush()
-            response = self.serial_port.read(17)
-            self.serial_port.flush()
-            # TODO: error checking etc.
-            encoded_value = response[8:-1]
-            decoded_value = struct.unpack('>f', binascii.unhexlify(encoded_value))[0]
-            return decoded_value
+        except SerialException:
+            log.debug("Failure reading densitrak", exc_info=sys.exc_info())
+            self.finish_poll()
+            return
+        self.timeout = self.io_loop.call_later(DENSITRAK_TIMEOUT_SECS, self.on_timeout)
+
+    def on_readable(self, fd, events):
+        try:
+            self.pending += self.serial_port.read(self.serial_port.inWaiting() or 1)
+        except SerialException:
+            log.exception("Unable to read from Densitrak serial port, stopping DensitrakHandler")
+            self.shutdown()
+            return
+        if self.timeout is None or len(self.pending) < DENSITRAK_RESPONSE_LEN:
+            return
+        self.io_loop.remove_timeout(self.timeout)
+        self.timeout = None
+        category = DENSITRAK_COMMANDS[len(self.readings)][0]
+        # Anything read past the end of the response is noise; the next command discards it
+        response, self.pending = self.pending[:DENSITRAK_RESPONSE_LEN], ''
+        try:
+            # The value is a big-endian float, sent as 8 hex digits before the final byte.
+            # A garbled value fails unhexlify or unpack, and the poll is abandoned.
+            value = DENSITRAK_FLOAT.unpack(
+                binascii.unhexlify(response[8:DENSITRAK_RESPONSE_LEN - 1]))[0]
+        except (TypeError, binascii.Error, struct.error):
+            log.debug("Failure reading densitrak", exc_info=sys.exc_info())
+            self.finish_poll()
+            return
+        if category == 'water_temp':
+            value = (value - 32.0) * (5.0 / 9)  # the Densitrak reports degrees F
+        self.readings.append((category, value))
+        if len(self.readings) < len(DENSITRAK_COMMANDS):
+            self.send_command()
+        else:
+            self.finish_poll()
+
+    def on_timeout(self):
+        self.timeout = None
+        log.debug("No response from densitrak")
+        self.finish_poll()
+
+    def finish_poll(self):
+        """Logs whatever was read in one go, and schedules the next poll"""
+        if self.readings:
+            log.debug("Logging densitrak readings: %s", self.readings)
+            self.tank_monitor._offer_log_records(time(), self.readings)
+            self.readings = []
+        if not self.stop_reading:
+            self.next_poll = self.io_loop.call_later(DENSITRAK_POLL_SECS, self.request_readings)
 
     def shutdown(self):
         self.stop_reading = True
+        for timeout in (self.timeout, self.next_poll):
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+        self.timeout = self.next_poll = None
+        self.io_loop.remove_handler(self.serial_port.fileno())
 
 class SyslogStatusHandler(RequestHandler):
 
+    _syslogs = []
+    _syslogs_refresh_at = 0
+
     def get(self, *args, **kwargs):
         self.finish(self.get_status())
 
     def post(self):
-        global log_level_reset_at
+        global log_level_reset_timeout, log_level_reset_desc
         log.setLevel(logging.DEBUG)
         log.debug("Log level temporarily set to DEBUG")
-        log_level_reset_at = datetime.now() + timedelta(minutes=30)
+        io_loop = self.application.io_loop
+        if log_level_reset_timeout is not None:
+            io_loop.remove_timeout(log_level_reset_timeout)
+        log_level_reset_timeout = io_loop.call_later(LOG_LEVEL_RESET_SECS,
+                                                     SyslogStatusHandler.reset_log_level)
+        log_level_reset_desc = strftime("%b %d %Y %H:%M:%S",
+                                        localtime(time() + LOG_LEVEL_RESET_SECS))
         self.finish(self.get_status())
 
+    @staticmethod
+    def reset_log_level():
+        global log_level_reset_timeout, log_level_reset_desc
+        log.info("Resetting logging level to INFO")
+        log.setLevel(logging.INFO)
+        log_level_reset_timeout = None
+        log_level_reset_desc = None
+
     def get_status(self):
         return {
             'level': log.getEffectiveLevel(),
-            'level_reset_at': None if log_level_reset_at is None else log_level_reset_at.strftime("%b %d %Y %H:%M:%S"),
-            'syslogs': filter(lambda x: x.startswith('tankmonitor.log'), os.listdir('syslog'))
+            'level_reset_at': log_level_reset_desc,
+            'syslogs': SyslogStatusHandler.get_syslogs()
         }
 
+    @staticmethod
+    def get_syslogs():
+        """The log files only change when they rotate, so the listing is cached for a few seconds"""
+        now = monotonic()
+        if now >= SyslogStatusHandler._syslogs_refresh_at:
+            SyslogStatusHandler._syslogs = [name for name in os.listdir('syslog')
+                                            if name.startswith('tankmonitor.log')]
+            SyslogStatusHandler._syslogs_refresh_at = now + SYSLOG_LIST_REFRESH_SECS
+        return SyslogStatusHandler._syslogs
+
 class SyslogFileHandler(StaticFileHandler):
 
     def get_content_type(self):
         return "text/plain"
 
 
+def load_template(path):
+    """Reads and compiles a template once, closing the file afterwards"""
+    with open(path, 'rb') as template_file:
+        return Template(template_file.read(), name=path)
+
+
 class AlertMailer(object):
 
     last_alert = None
-    generic_alert_mail = Template(open('templates/generic_alert.txt', 'rb').read())
+    # Alerts reuse one logged-in SMTP connection rather than reconnecting for every e-mail
+    smtp_conn = None
+    smtp_lock = Lock()
+    generic_alert_mail = load_template('templates/generic_alert.txt')
+    level_alert_subject = "[TWUC Alert] Tank Warning"
+    delta_alert_subject = "[TWUC Alert] Tank Delta Warning"
+    mail_to = ', '.join(appconfig.EMAIL['distribution'])
 
     alert_config_by_category = {
         'density': {
@@ -412,44 +699,87 @@ class AlertMailer(object):
             'log_unit': appconfig.LOG_UNITS['depth'],
         }
     }
+    # Template arguments for each kind of alert, keyed by (category, is rate of change alert)
+    alert_configs = dict(
+        ((category, is_delta),
+         dict(config, alert_threshold=(appconfig.ALERT_RATE_THRESHOLDS if is_delta else
+                                       appconfig.ALERT_THRESHOLDS)[category]))
+        for category, config in alert_config_by_category.items()
+        for is_delta in (True, False))
 
     @staticmethod
     def send_message(alert_text, tank_alert):
         msg = MIMEText(alert_text)
-        msg[
-            'Subject'] = "[TWUC Alert] Tank Warning" if not tank_alert.delta else "[TWUC Alert] Tank Delta Warning"
+        msg['Subject'] = AlertMailer.delta_alert_subject if tank_alert.delta else \
+            AlertMailer.level_alert_subject
         msg['From'] = appconfig.EMAIL['sending_address']
-        msg['To'] = ', '.join(appconfig.EMAIL['distribution'])
-        conn = None
+        msg['To'] = AlertMailer.mail_to
+        with AlertMailer.smtp_lock:
+            conn = AlertMailer.get_smtp_connection()
+            try:
+                conn.sendmail(appconfig.EMAIL['sending_address'], appconfig.EMAIL['distribution'],
+                              msg.as_string())
+            except (smtplib.SMTPException, socket.error):
+                # Don't reuse a connection in an unknown state
+                AlertMailer.close_smtp_connection()
+                raise
+
+    @staticmethod
+    def get_smtp_connection():
+        """Returns the open SMTP connection if the server still answers a NOOP on it, otherwise
+        connects and logs in again. Must be called with smtp_lock held."""
+        conn = AlertMailer.smtp_conn
+        if conn is not None:
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, socket.error):
+                pass
+            AlertMailer.close_smtp_connection()
+        conn = smtplib.SMTP(
+            "%s:%d" % (appconfig.EMAIL['smtp_server'], appconfig.EMAIL['smtp_port']))
         try:
-            conn = smtplib.SMTP(
-                "%s:%d" % (appconfig.EMAIL['smtp_server'], appconfig.EMAIL['smtp_port']))
             if appconfig.EMAIL['smtp_tls']:
                 conn.starttls()
             conn.login(appconfig.EMAIL['sending_address'], appconfig.EMAIL['sending_password'])
-            conn.sendmail(appconfig.EMAIL['sending_address'], appconfig.EMAIL['distribution'],
-                          msg.as_string())
-        finally:
-            if conn:
+        except:
+            conn.close()
+            raise
+        AlertMailer.smtp_conn = conn
+        return conn
+
+    @staticmethod
+    def close_smtp_connection():
+        conn, AlertMailer.smtp_conn = AlertMailer.smtp_conn, None
+        if conn is not None:
+            try:
                 conn.quit()
+            except (smtplib.SMTPException, socket.error):
+                conn.close()
+
+    @staticmethod
+    def check_sent(future):
+        if future.exception() is not None:
+            log.error("Unable to send e-mail alert: %s", future.exception())
 
     @staticmethod
-    @coroutine
     def offer(category, tank_alert):
-        offer_time = time()
+        """Sends an e-mail alert, unless one has already been sent within the alert period. The
+        e-mail is sent from the thread pool, so this returns without waiting for it."""
+        offer_time = monotonic()
         if AlertMailer.last_alert is None or \
-                (offer_time - AlertMailer.last_alert) > appconfig.EMAIL['period']:
-            alert_config = AlertMailer.alert_config_by_category[category].copy()
-            alert_config['alert'] = tank_alert
-            alert_config['alert_threshold'] = appconfig.ALERT_RATE_THRESHOLDS[category] if tank_alert.delta else appconfig.ALERT_THRESHOLDS[category]
-            alert_text = AlertMailer.generic_alert_mail.generate(**alert_config)
-            log.warn("Sending e-mail alert due to %s %s" % (category, str(tank_alert)))
+                (offer_time - AlertMailer.last_alert) > EMAIL_PERIOD:
+            alert_config = AlertMailer.alert_configs[(category, bool(tank_alert.delta))]
+            alert_text = AlertMailer.generic_alert_mail.generate(alert=tank_alert, **alert_config)
+            log.warn("Sending e-mail alert due to %s %s", category, tank_alert)
             log.warn(alert_text)
             AlertMailer.last_alert = offer_time
-            yield thread_pool.submit(lambda: AlertMailer.send_message(alert_text, tank_alert))
+            thread_pool.submit(AlertMailer.send_message, alert_text, tank_alert).add_done_callback(
+                AlertMailer.check_sent)
 
 
 if __name__ == "__main__":
+    BackgroundLogHandler.start([logging.getLogger(), log])
     event_router = SockJSRouter(EventConnection, '/event')
     handlers = [
         (r'/', MainPageHandler),
@@ -462,7 +792,7 @@ if __name__ == "__main__":
     tornado_settings = {
         'static_path': 'static',
         'template_path': 'templates',
-        'debug': True
+        'debug': os.environ.get('TANKMONITOR_DEBUG') == '1'
     }
     lcd.init()
     lcd.gotoxy(0, 0)
@@ -476,31 +806,45 @@ if __name__ == "__main__":
     wiringpi.pinMode(BTN_IN, 0)
 
     app = TankMonitor(handlers, **tornado_settings)
-    ioloop = IOLoop.instance()
-    disp_print_cb = PeriodicCallback(app.update_display, callback_time=500, io_loop=ioloop)
-    disp_print_cb.start()
-    button_poll_cb = PeriodicCallback(app.poll_display_button, callback_time=100, io_loop=ioloop)
-    button_poll_cb.start()
-    log_level_cb = PeriodicCallback(app.log_level_reset, callback_time=10*1000, io_loop=ioloop)
-    log_level_cb.start()
+    ioloop = app.io_loop
+    if hasattr(wiringpi, 'wiringPiISR'):
+        # The button wakes the display through an edge interrupt, so only the display is polled
+        wiringpi.wiringPiISR(BTN_IN, wiringpi.INT_EDGE_RISING, app.on_display_button)
+        display_cb = PeriodicCallback(app.update_display, callback_time=DISPLAY_REFRESH_MS,
+                                      io_loop=ioloop)
+    else:
+        display_cb = PeriodicCallback(app.poll_display, callback_time=BUTTON_POLL_MS,
+                                      io_loop=ioloop)
+    display_cb.start()
+    event_flush_cb = PeriodicCallback(app.flush_events, callback_time=EVENT_FLUSH_MS, io_loop=ioloop)
+    event_flush_cb.start()
 
     http_server = HTTPServer(app)
     http_server.listen(listen_port)
-    log.info("Listening on port " + str(listen_port))
+    log.info("Listening on port %d", listen_port)
+    serial_handlers = []
     try:
-        maxbotix = MaxbotixHandler(tank_monitor=app, port='/dev/ttyAMA0', timeout=10)
+        maxbotix = MaxbotixHandler(tank_monitor=app, port='/dev/ttyAMA0', timeout=0)
         maxbotix.calibrate(appconfig.MAXBOTICS['calibrate_m'],
                            appconfig.MAXBOTICS['calibrate_b'])
-        maxbotix_thread = Thread(target=maxbotix.read)
-        maxbotix_thread.daemon = True
-        maxbotix_thread.start()
+        maxbotix.start()
+        serial_handlers.append(maxbotix)
     except Exception as e:
         log.error("Unable to setup MaxbotixHandler", exc_info=e)
     try:
         densitrak = DensitrakHandler(app, '/dev/ttyUSB0')
-        densitrak_thread = Thread(target=densitrak.read)
-        densitrak_thread.daemon = True
-        densitrak_thread.start()
+        densitrak.start()
+        serial_handlers.append(densitrak)
     except Exception as e:
         log.error("Unable to setup DensitrakHandler", exc_info=e)
+
+    # Stop the IOLoop on SIGTERM (sent by the init script) so shutdown runs below and the
+    # atexit handlers write out any queued log records
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: ioloop.add_callback_from_signal(ioloop.stop))
     ioloop.start()
+    log.info("Shutting down")
+    http_server.stop()
+    for serial_handler in serial_handlers:
+        serial_handler.shutdown()
+        serial_handler.serial_port.close()